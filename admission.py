@@ -0,0 +1,203 @@
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+
+import metrics
+
+# 当前请求的截止时间 (time.monotonic())，在各个接口入口处设置
+_deadline = ContextVar("ecust_deadline", default=None)
+
+ADMISSION_QUEUE = metrics.REGISTRY.register(metrics.Gauge(
+    "ecust_admission_queue_depth", "Requests waiting for an upstream slot.", labels=("upstream",)))
+ADMISSION_ACTIVE = metrics.REGISTRY.register(metrics.Gauge(
+    "ecust_admission_active", "Upstream calls currently holding a slot.", labels=("upstream",)))
+ADMISSION_SHED = metrics.REGISTRY.register(metrics.Counter(
+    "ecust_admission_shed_total", "Requests rejected before calling the upstream.", labels=("upstream", "reason")))
+ADMISSION_RATE = metrics.REGISTRY.register(metrics.Gauge(
+    "ecust_admission_rate", "Currently allowed upstream request rate (req/s, AIMD-adjusted).",
+    labels=("upstream",)))
+
+
+class Overloaded(Exception):
+    """排队已满或无法在截止时间前获得上游配额，请求被提前拒绝。"""
+
+
+def set_deadline(seconds):
+    _deadline.set(time.monotonic() + seconds)
+
+
+def remaining():
+    """距当前请求截止还剩多少秒，未设置截止时间时返回 None。"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+@contextmanager
+def reserve_time(seconds):
+    """在 with 块内把截止时间提前 seconds 秒，为之后的阶段留出时间；未设置截止时间时不起作用。"""
+    deadline = _deadline.get()
+    if deadline is None:
+        yield
+        return
+    token = _deadline.set(deadline - seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def parse_retry_after(value):
+    """解析 Retry-After 头 (秒数或 HTTP 日期)，无法解析时返回 None。"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """令牌桶限速，速率按 AIMD 调整：被限流时乘性减小，成功时加性恢复到上限。
+
+    同一次过载往往同时打回一批并发请求，因此每个 cooldown 窗口 (或 Retry-After 暂停期) 内
+    只减速一次，后续的 429 只延长暂停时间。
+    """
+
+    def __init__(self, rate, burst, min_rate=0.5, decrease=0.5, increase=None, cooldown=1.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min(min_rate, rate)
+        self.decrease = decrease
+        # 默认每次成功恢复上限的 2%，约 50 次成功后从最低点回到满速
+        self.increase = increase if increase is not None else rate / 50
+        self.cooldown = cooldown
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.decreased_at = float("-inf")
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, budget):
+        """预订一个令牌，返回需要等待的秒数；等待超过 budget 时不预订并返回 None。"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.paused_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        if budget is not None and wait > budget:
+            return None
+        # 令牌允许为负，后来者会按顺序排在更后面
+        self.tokens -= 1
+        return wait
+
+    def on_throttled(self, retry_after=None):
+        now = time.monotonic()
+        if now >= max(self.paused_until, self.decreased_at + self.cooldown):
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.decreased_at = now
+        self.tokens = min(self.tokens, 0.0)
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class Gate:
+    """单个上游的准入控制：并发信号量 + 有界等待队列 + 令牌桶。
+
+    等待时间会对照当前请求的截止时间 (扣除预计服务时间 reserve)，
+    注定赶不上的请求直接抛出 Overloaded，而不是排队到超时。
+    """
+
+    def __init__(self, name, concurrency, max_queue, bucket=None, reserve=0.0):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.bucket = bucket
+        self.reserve = reserve
+        self._sem = asyncio.Semaphore(concurrency)
+        self.waiting = 0
+        self.active = 0
+        if bucket is not None:
+            ADMISSION_RATE.labels(name).set(bucket.rate)
+
+    @classmethod
+    def from_env(cls, name, concurrency, max_queue, rate, burst, reserve):
+        """按 `<NAME>_CONCURRENCY`、`_QUEUE`、`_RATE` (req/s，0 为不限速)、`_BURST` 环境变量配置。"""
+        prefix = name.upper()
+        rate = float(os.getenv(f"{prefix}_RATE", rate))
+        bucket = TokenBucket(rate, float(os.getenv(f"{prefix}_BURST", burst))) if rate > 0 else None
+        return cls(
+            name,
+            concurrency=int(os.getenv(f"{prefix}_CONCURRENCY", concurrency)),
+            max_queue=int(os.getenv(f"{prefix}_QUEUE", max_queue)),
+            bucket=bucket,
+            reserve=float(os.getenv(f"{prefix}_RESERVE", reserve)),
+        )
+
+    def _shed(self, reason):
+        ADMISSION_SHED.labels(self.name, reason).inc()
+        raise Overloaded(f"{self.name} 繁忙 ({reason})")
+
+    def _budget(self):
+        left = remaining()
+        return None if left is None else left - self.reserve
+
+    @asynccontextmanager
+    async def slot(self):
+        budget = self._budget()
+        if budget is not None and budget <= 0:
+            self._shed("deadline")
+        if self._sem.locked():
+            if self.waiting >= self.max_queue:
+                self._shed("queue_full")
+            self.waiting += 1
+            ADMISSION_QUEUE.labels(self.name).set(self.waiting)
+            try:
+                await asyncio.wait_for(self._sem.acquire(), timeout=budget)
+            except asyncio.TimeoutError:
+                self._shed("deadline")
+            finally:
+                self.waiting -= 1
+                ADMISSION_QUEUE.labels(self.name).set(self.waiting)
+        else:
+            await self._sem.acquire()
+
+        try:
+            if self.bucket is not None:
+                wait = self.bucket.reserve(self._budget())
+                if wait is None:
+                    self._shed("rate_limit")
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            self.active += 1
+            ADMISSION_ACTIVE.labels(self.name).set(self.active)
+            try:
+                yield
+            finally:
+                self.active -= 1
+                ADMISSION_ACTIVE.labels(self.name).set(self.active)
+        finally:
+            self._sem.release()
+
+    def on_throttled(self, retry_after=None):
+        if self.bucket is not None:
+            self.bucket.on_throttled(retry_after)
+            ADMISSION_RATE.labels(self.name).set(self.bucket.rate)
+
+    def on_success(self):
+        if self.bucket is not None and self.bucket.rate < self.bucket.max_rate:
+            self.bucket.on_success()
+            ADMISSION_RATE.labels(self.name).set(self.bucket.rate)
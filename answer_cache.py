@@ -0,0 +1,86 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+
+from search_cache import backend_from_env, call_backend, normalize_query
+
+logger = logging.getLogger("ECUST_Assistant")
+
+# 以这些前缀开头的是错误提示而不是回答，绝不能缓存
+ERROR_PREFIXES = ("❌", "⚠️", "🔧")
+
+
+def is_cacheable(answer):
+    return bool(answer) and not answer.startswith(ERROR_PREFIXES)
+
+
+class AnswerCache:
+    """Moonshot 回答缓存，支持 stale-while-revalidate。
+
+    键 = 归一化问题 | 模型名 | 检索资料的哈希，资料变化时自然失效。
+    过了 fresh_ttl 的条目仍会立即返回，同时在后台重新生成；超过 fresh_ttl + stale_ttl 才真正过期。
+    """
+
+    def __init__(self, backend, fresh_ttl=1800.0, stale_ttl=86400.0):
+        self.backend = backend
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self._refreshing = {}
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            backend_from_env("ANSWER_CACHE", 512),
+            fresh_ttl=float(os.getenv("ANSWER_CACHE_TTL", 1800)),
+            stale_ttl=float(os.getenv("ANSWER_CACHE_STALE_TTL", 86400)),
+        )
+
+    @staticmethod
+    def make_key(q, search_context, model):
+        digest = hashlib.sha1(search_context.encode("utf-8")).hexdigest()[:16]
+        return f"{normalize_query(q)}|{model}|{digest}"
+
+    async def put(self, key, answer):
+        if not is_cacheable(answer):
+            return
+        await call_backend(self.backend, "set", key, {"answer": answer, "created": time.time()},
+                           self.fresh_ttl + self.stale_ttl)
+
+    async def get(self, key, refresh=None):
+        """返回缓存的回答或 None。条目已陈旧且提供了 refresh 时，在后台调用它重新生成。
+
+        refresh 是一个返回回答字符串的协程函数。
+        """
+        entry = await call_backend(self.backend, "get", key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        if time.time() - entry["created"] <= self.fresh_ttl:
+            self.stats["hits"] += 1
+        else:
+            self.stats["stale_hits"] += 1
+            if refresh is not None and key not in self._refreshing:
+                self._refreshing[key] = asyncio.ensure_future(self._refresh(key, refresh))
+        return entry["answer"]
+
+    async def _refresh(self, key, refresh):
+        try:
+            self.stats["refreshes"] += 1
+            await self.put(key, await refresh())
+        except Exception as e:
+            logger.error(f"回答缓存后台刷新失败: {e}")
+        finally:
+            self._refreshing.pop(key, None)
+
+    async def purge(self, prefix):
+        """删除问题以 prefix 开头的条目，prefix 按与问题相同的规则归一化。"""
+        return await call_backend(self.backend, "delete_prefix", normalize_query(prefix))
+
+    async def invalidate_all(self):
+        return await call_backend(self.backend, "clear")
+
+    def snapshot(self):
+        return {**self.stats, "refreshing": len(self._refreshing), "size": len(self.backend)}
@@ -0,0 +1,396 @@
+"""离线压测驱动：按目标 QPS 或并发数回放 JSONL 问题日志，输出 p50/p95/p99、吞吐量和错误率。
+
+默认会在本机启动 bench/stub_servers.py 模拟的上游，以及指向它的 main:app (uvicorn 子进程)，
+整个过程不访问外网。例如：
+
+    python bench/loadgen.py --concurrency 8 --requests 200 --out bench_output.json
+    python bench/loadgen.py --qps 5 --duration 30 --endpoint stream --baseline bench_output.json
+
+问题日志每行一个 JSON 对象，取 "q"、"question" 或 "title" 字段；默认按文件顺序循环回放，
+保留日志里的提问顺序和重复模式，--shuffle 则先按 --seed 打乱一次再循环。
+
+本机启动的被测服务默认关闭搜索缓存和回答缓存 (SEARCH_CACHE_SIZE=0、ANSWER_CACHE_SIZE=0)，
+否则样例问题很快全部命中缓存，测到的是缓存而不是完整流程。要测缓存效果时用
+--app-env SEARCH_CACHE_SIZE=1024 --app-env ANSWER_CACHE_SIZE=512 之类的参数覆盖。
+--target 指向已运行的服务时不启动任何子进程；--stub-arg 原样传给 stub_servers.py，
+--app-env KEY=VALUE 用于设置被测服务的环境变量 (例如关闭回答缓存)。
+"""
+import os
+import sys
+import json
+import time
+import socket
+import random
+import asyncio
+import argparse
+import subprocess
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from answer_cache import ERROR_PREFIXES  # noqa: E402
+
+
+def load_questions(path):
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            q = item if isinstance(item, str) else item.get("q") or item.get("question") or item.get("title")
+            if q:
+                questions.append(q)
+    if not questions:
+        raise SystemExit(f"{path} 中没有可用的问题")
+    return questions
+
+
+class Replay:
+    """按顺序循环取问题；shuffle 时先用给定的随机数生成器打乱一次。"""
+
+    def __init__(self, questions, rng=None):
+        self.questions = list(questions)
+        if rng is not None:
+            rng.shuffle(self.questions)
+        self.pos = 0
+
+    def next(self):
+        q = self.questions[self.pos % len(self.questions)]
+        self.pos += 1
+        return q
+
+
+# 本机启动被测服务时的默认环境变量：关闭两级缓存，可被 --app-env 覆盖
+DEFAULT_APP_ENV = {"SEARCH_CACHE_SIZE": "0", "ANSWER_CACHE_SIZE": "0"}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url, proc, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"子进程提前退出 (代码 {proc.returncode})")
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise SystemExit(f"等待 {url} 就绪超时")
+
+
+class Harness:
+    """在本机启动模拟上游和被测服务，退出时一并关闭。"""
+
+    def __init__(self, stub_args, app_env, workers, verbose=False):
+        self.stub_args = stub_args
+        self.app_env = app_env
+        self.workers = workers
+        # 被测服务默认打印 INFO 日志，压测时不输出以免淹没报告
+        self.output = None if verbose else subprocess.DEVNULL
+        self.procs = []
+        self.target = None
+
+    def __enter__(self):
+        stub_port, app_port = free_port(), free_port()
+        stub = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "stub_servers.py"),
+                                 "--port", str(stub_port), *self.stub_args])
+        self.procs.append(stub)
+        # stub 对 GET / 返回 404，能连上即可
+        wait_ready(f"http://127.0.0.1:{stub_port}/", stub)
+
+        env = {
+            **os.environ,
+            "MOONSHOT_API_KEY": "bench",
+            "BOCHA_API_KEY": "bench",
+            "BOCHA_BASE_URL": f"http://127.0.0.1:{stub_port}",
+            "MOONSHOT_BASE_URL": f"http://127.0.0.1:{stub_port}",
+            **DEFAULT_APP_ENV,
+            **self.app_env,
+        }
+        app = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+                                "--port", str(app_port), "--workers", str(self.workers),
+                                "--log-level", "warning"], cwd=REPO_DIR, env=env,
+                               stdout=self.output, stderr=self.output)
+        self.procs.append(app)
+        self.target = f"http://127.0.0.1:{app_port}"
+        wait_ready(self.target + "/", app)
+        return self
+
+    def __exit__(self, *exc):
+        for proc in reversed(self.procs):
+            proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def parse_server_timing(header):
+    stages = {}
+    for part in (header or "").split(","):
+        name, _, dur = part.strip().partition(";dur=")
+        if name and dur:
+            stages[name] = float(dur)
+    return stages
+
+
+async def one_request(client, endpoint, q):
+    """发送一个请求，返回记录：延迟、首 token 时间 (仅流式)、是否成功、Server-Timing。"""
+    start = time.perf_counter()
+    record = {"ttft": None, "ok": False, "error": None, "stages": {}}
+    try:
+        if endpoint == "stream":
+            async with client.stream("GET", "/chat/stream", params={"q": q}) as r:
+                record["status"] = r.status_code
+                event = None
+                async for line in r.aiter_lines():
+                    if line.startswith("event:"):
+                        event = line[6:].strip()
+                        if event == "token" and record["ttft"] is None:
+                            record["ttft"] = time.perf_counter() - start
+                    elif line.startswith("data:") and event == "error":
+                        record["error"] = json.loads(line[5:]).get("message")
+                    elif line.startswith("data:") and event == "done":
+                        record["ok"] = record["error"] is None
+        else:
+            r = await client.get("/chat", params={"q": q})
+            record["status"] = r.status_code
+            record["stages"] = parse_server_timing(r.headers.get("server-timing"))
+            answer = r.json().get("answer", "") if r.status_code == 200 else ""
+            if r.status_code != 200:
+                record["error"] = f"HTTP {r.status_code}"
+            elif answer.startswith(ERROR_PREFIXES):
+                record["error"] = answer
+            else:
+                record["ok"] = True
+    except Exception as e:
+        record["status"] = None
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["latency"] = time.perf_counter() - start
+    return record
+
+
+async def run_closed(client, replay, endpoint, concurrency, total, duration):
+    """闭环压测：concurrency 个 worker 各自连续发送请求。"""
+    records = []
+    stop_at = time.monotonic() + duration if duration else None
+    issued = 0
+
+    async def worker():
+        nonlocal issued
+        while (total is None or issued < total) and (stop_at is None or time.monotonic() < stop_at):
+            issued += 1
+            records.append(await one_request(client, endpoint, replay.next()))
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return records
+
+
+async def run_open(client, replay, rng, endpoint, qps, total, duration, poisson):
+    """开环压测：按目标 QPS 发出请求，不等待前一个完成。
+
+    延迟从计划发出的时间算起，避免服务变慢时发压也跟着变慢而掩盖排队时间 (coordinated omission)。
+    """
+    tasks = []
+    start = time.perf_counter()
+    scheduled = 0.0
+    count = 0
+
+    async def timed_request(planned, q):
+        record = await one_request(client, endpoint, q)
+        record["latency"] = max(record["latency"], time.perf_counter() - start - planned)
+        return record
+
+    while (total is None or count < total) and (duration is None or scheduled < duration):
+        delay = scheduled - (time.perf_counter() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(timed_request(scheduled, replay.next())))
+        count += 1
+        scheduled += rng.expovariate(qps) if poisson else 1.0 / qps
+    return list(await asyncio.gather(*tasks))
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(records, wall):
+    def stats(values):
+        values = sorted(values)
+        if not values:
+            return None
+        return {"p50": percentile(values, 50) * 1000, "p95": percentile(values, 95) * 1000,
+                "p99": percentile(values, 99) * 1000, "mean": sum(values) / len(values) * 1000,
+                "max": values[-1] * 1000}
+
+    ok = [r for r in records if r["ok"]]
+    errors = {}
+    for r in records:
+        if not r["ok"]:
+            key = (r["error"] or f"HTTP {r['status']}")[:80]
+            errors[key] = errors.get(key, 0) + 1
+    stage_names = sorted({name for r in ok for name in r["stages"]})
+    return {
+        "requests": len(records),
+        "ok": len(ok),
+        "error_rate": (len(records) - len(ok)) / len(records) if records else 0.0,
+        "duration_s": wall,
+        "throughput_rps": len(ok) / wall if wall else 0.0,
+        "latency_ms": stats([r["latency"] for r in ok]),
+        "ttft_ms": stats([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "stages_mean_ms": {name: sum(r["stages"].get(name, 0.0) for r in ok) / len(ok) for name in stage_names},
+        "errors": errors,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result):
+    s = result["summary"]
+    print(f"\n提交 {result['commit']}  endpoint={result['config']['endpoint']}  "
+          f"模式={result['config']['mode']}")
+    print(f"请求 {s['requests']}  成功 {s['ok']}  错误率 {s['error_rate']:.2%}  "
+          f"吞吐 {s['throughput_rps']:.2f} req/s  用时 {s['duration_s']:.1f}s")
+    for name in ("latency_ms", "ttft_ms"):
+        if s[name]:
+            v = s[name]
+            print(f"{name:<11} p50 {v['p50']:8.1f}  p95 {v['p95']:8.1f}  p99 {v['p99']:8.1f}  "
+                  f"mean {v['mean']:8.1f}  max {v['max']:8.1f}")
+    if s["stages_mean_ms"]:
+        print("各阶段平均 (ms): " + ", ".join(f"{k}={v:.1f}" for k, v in s["stages_mean_ms"].items()))
+    for error, count in sorted(s["errors"].items(), key=lambda x: -x[1]):
+        print(f"  错误 x{count}: {error}")
+
+
+def compare(result, baseline, max_regression):
+    """与基线比较，返回超过阈值的退化项列表。"""
+    cur, base = result["summary"], baseline["summary"]
+    regressions = []
+    print(f"\n对比基线 (提交 {baseline.get('commit')}):")
+    if baseline.get("config") != result["config"]:
+        print("  注意：压测配置与基线不同，结果不可直接比较")
+    for metric in ("p50", "p95", "p99"):
+        a, b = (cur["latency_ms"] or {}).get(metric), (base["latency_ms"] or {}).get(metric)
+        if a is None or not b:
+            continue
+        change = (a - b) / b
+        print(f"  latency {metric}: {b:.1f} -> {a:.1f} ms ({change:+.1%})")
+        if change > max_regression:
+            regressions.append(f"latency {metric} +{change:.1%}")
+    if base["throughput_rps"]:
+        change = (cur["throughput_rps"] - base["throughput_rps"]) / base["throughput_rps"]
+        print(f"  throughput: {base['throughput_rps']:.2f} -> {cur['throughput_rps']:.2f} req/s ({change:+.1%})")
+        if -change > max_regression:
+            regressions.append(f"throughput {change:.1%}")
+    delta = cur["error_rate"] - base["error_rate"]
+    print(f"  error rate: {base['error_rate']:.2%} -> {cur['error_rate']:.2%}")
+    if delta > 0.01:
+        regressions.append(f"error rate +{delta:.2%}")
+    return regressions
+
+
+async def drive(args, target, questions):
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=target, timeout=args.timeout, limits=limits) as client:
+        # 预热：建立连接、加载本地索引等，不计入结果
+        for q in questions[:args.warmup]:
+            await one_request(client, args.endpoint, q)
+        replay = Replay(questions, random.Random(args.seed) if args.shuffle else None)
+        start = time.perf_counter()
+        if args.qps:
+            records = await run_open(client, replay, rng, args.endpoint, args.qps,
+                                     args.requests, args.duration, args.poisson)
+        else:
+            records = await run_closed(client, replay, args.endpoint, args.concurrency,
+                                       args.requests, args.duration)
+        return records, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="离线压测 /chat 与 /chat/stream")
+    parser.add_argument("--questions", default=os.path.join(BENCH_DIR, "questions.jsonl"))
+    parser.add_argument("--endpoint", choices=("chat", "stream"), default="chat")
+    parser.add_argument("--qps", type=float, help="开环模式的目标 QPS；不指定时使用闭环并发模式")
+    parser.add_argument("--poisson", action="store_true", help="开环模式下按泊松过程发压")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, help="总请求数")
+    parser.add_argument("--duration", type=float, help="压测时长 (秒)")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shuffle", action="store_true", help="打乱问题顺序后再循环回放 (默认按文件顺序)")
+    parser.add_argument("--target", help="已运行服务的地址；不指定时在本机启动模拟上游和被测服务")
+    parser.add_argument("--workers", type=int, default=1, help="被测服务的 uvicorn worker 数")
+    parser.add_argument("--stub-arg", action="append", default=[], help="传给 stub_servers.py 的参数")
+    parser.add_argument("--app-env", action="append", default=[], help="被测服务的环境变量 KEY=VALUE")
+    parser.add_argument("--verbose", action="store_true", help="显示被测服务的日志")
+    parser.add_argument("--out", help="把结果写成 JSON 文件")
+    parser.add_argument("--baseline", help="与之前 --out 的结果对比")
+    parser.add_argument("--max-regression", type=float, default=0.1,
+                        help="延迟/吞吐量退化超过该比例时以非零状态退出")
+    args = parser.parse_args(argv)
+    if args.requests is None and args.duration is None:
+        args.requests = 100
+
+    questions = load_questions(args.questions)
+    app_env = dict(item.split("=", 1) for item in args.app_env)
+    stub_args = [a for item in args.stub_arg for a in item.split()]
+
+    if args.target:
+        records, wall = asyncio.run(drive(args, args.target, questions))
+    else:
+        with Harness(stub_args, app_env, args.workers, args.verbose) as harness:
+            records, wall = asyncio.run(drive(args, harness.target, questions))
+
+    result = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "endpoint": args.endpoint,
+            "mode": f"qps={args.qps}" if args.qps else f"concurrency={args.concurrency}",
+            "requests": args.requests, "duration": args.duration, "seed": args.seed, "shuffle": args.shuffle,
+            "workers": args.workers, "stub_args": stub_args,
+            "app_env": app_env if args.target else {**DEFAULT_APP_ENV, **app_env},
+            "target": args.target or "local",
+        },
+        "summary": summarize(records, wall),
+    }
+    print_report(result)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.max_regression)
+        if regressions:
+            print("性能退化: " + "; ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""本地模拟的 Bocha / Moonshot 上游，用于离线压测，不消耗真实 API 额度。
+
+同一个进程同时提供 /v1/web-search 和 /v1/chat/completions (含 stream=true)，
+延迟分布、错误率和 429 行为都可以通过命令行配置，例如：
+
+    python bench/stub_servers.py --port 9100 --llm-ttft lognormal:400:0.5 --llm-error-rate 0.01
+"""
+import sys
+import json
+import random
+import asyncio
+import hashlib
+import argparse
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+
+
+def parse_latency(spec):
+    """把延迟分布描述解析成采样函数 (返回秒)。单位均为毫秒：
+
+    fixed:100 | uniform:50:200 | lognormal:<中位数>:<sigma> | exp:<均值>
+    """
+    kind, *args = spec.split(":")
+    args = [float(a) for a in args]
+    if kind == "fixed":
+        return lambda rng: args[0] / 1000
+    if kind == "uniform":
+        return lambda rng: rng.uniform(args[0], args[1]) / 1000
+    if kind == "lognormal":
+        median, sigma = args
+        return lambda rng: median * rng.lognormvariate(0, sigma) / 1000
+    if kind == "exp":
+        return lambda rng: rng.expovariate(1 / args[0]) / 1000
+    raise ValueError(f"未知的延迟分布: {spec}")
+
+
+class StubConfig:
+    def __init__(self, args):
+        self.rng = random.Random(args.seed)
+        self.search_latency = parse_latency(args.search_latency)
+        self.search_error_rate = args.search_error_rate
+        self.search_429_rate = args.search_429_rate
+        self.search_results = args.search_results
+        self.llm_ttft = parse_latency(args.llm_ttft)
+        self.llm_token_delay = parse_latency(args.llm_token_delay)
+        self.llm_tokens = args.llm_tokens
+        self.llm_error_rate = args.llm_error_rate
+        self.llm_429_rate = args.llm_429_rate
+        self.llm_max_concurrency = args.llm_max_concurrency
+        self.retry_after = args.retry_after
+        self.llm_active = 0
+
+
+def too_many_requests(config):
+    return JSONResponse({"error": {"message": "rate limited", "type": "rate_limit_reached_error"}},
+                        status_code=429, headers={"Retry-After": str(config.retry_after)})
+
+
+def create_app(config):
+    app = FastAPI()
+
+    @app.post("/v1/web-search")
+    async def web_search(request: Request):
+        body = await request.json()
+        roll = config.rng.random()
+        if roll < config.search_429_rate:
+            return too_many_requests(config)
+        await asyncio.sleep(config.search_latency(config.rng))
+        if roll < config.search_429_rate + config.search_error_rate:
+            return JSONResponse({"message": "stub error"}, status_code=500)
+        # 摘要内容由查询决定，同一问题每次返回相同结果，便于复现
+        seed = hashlib.sha1(body["query"].encode("utf-8")).hexdigest()
+        pages = [{
+            "name": f"华理模拟网页 {seed[:6]}-{i}",
+            "url": f"https://stub.ecust.edu.cn/{seed[:12]}/{i}",
+            "snippet": f"{body['query']}：这是第 {i} 条模拟摘要，内容编号 {seed[i:i + 8]}，"
+                       f"用于压测华东理工大学校园问答的检索与上下文打包流程。",
+        } for i in range(config.search_results)]
+        return {"code": 200, "data": {"webPages": {"value": pages}}}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        roll = config.rng.random()
+        if roll < config.llm_429_rate or (
+                config.llm_max_concurrency and config.llm_active >= config.llm_max_concurrency):
+            return too_many_requests(config)
+
+        # 首 token 之前的等待单独计数：流式响应的生成器可能根本不会启动 (客户端在第一个分片前断开)，
+        # 它的 finally 也就不会执行，因此生成器只在自己的生命周期内计数
+        config.llm_active += 1
+        try:
+            await asyncio.sleep(config.llm_ttft(config.rng))
+        finally:
+            config.llm_active -= 1
+        if roll < config.llm_429_rate + config.llm_error_rate:
+            return JSONResponse({"error": {"message": "stub error"}}, status_code=500)
+
+        tokens = [f"模拟回答{i}" for i in range(config.llm_tokens)]
+        prompt_tokens = sum(len(m["content"]) for m in body["messages"]) // 2
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens + len(tokens)}
+
+        if not body.get("stream"):
+            config.llm_active += 1
+            try:
+                await asyncio.sleep(sum(config.llm_token_delay(config.rng) for _ in tokens))
+            finally:
+                config.llm_active -= 1
+            return {"model": body["model"], "usage": usage,
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": "".join(tokens)}}]}
+
+        async def events():
+            config.llm_active += 1
+            try:
+                for token in tokens:
+                    chunk = {"choices": [{"index": 0, "delta": {"content": token}}]}
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                    await asyncio.sleep(config.llm_token_delay(config.rng))
+                final = {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop", "usage": usage}]}
+                yield f"data: {json.dumps(final)}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                config.llm_active -= 1
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="本地模拟 Bocha / Moonshot 上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--search-latency", default="lognormal:300:0.4", help="Bocha 延迟分布 (毫秒)")
+    parser.add_argument("--search-error-rate", type=float, default=0.0)
+    parser.add_argument("--search-429-rate", type=float, default=0.0)
+    parser.add_argument("--search-results", type=int, default=8)
+    parser.add_argument("--llm-ttft", default="lognormal:500:0.4", help="Moonshot 首个 token 延迟分布 (毫秒)")
+    parser.add_argument("--llm-token-delay", default="fixed:20", help="Moonshot 每个 token 的间隔 (毫秒)")
+    parser.add_argument("--llm-tokens", type=int, default=60)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-429-rate", type=float, default=0.0)
+    parser.add_argument("--llm-max-concurrency", type=int, default=0, help="超过该并发数返回 429，0 为不限制")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429 响应里的 Retry-After 秒数")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    uvicorn.run(create_app(StubConfig(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,135 @@
+import os
+import re
+import math
+from collections import Counter
+
+from local_index import query_terms, tokenize
+
+# Moonshot 各档模型的上下文窗口 (tokens)，按从小到大排列
+MODEL_TIERS = [
+    (8 * 1024, "moonshot-v1-8k"),
+    (32 * 1024, "moonshot-v1-32k"),
+    (128 * 1024, "moonshot-v1-128k"),
+]
+
+_CJK_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\u3000-\u303f\uff00-\uffef]")
+_WORD_RE = re.compile(r"[A-Za-z0-9]+")
+
+
+def estimate_tokens(text):
+    """粗略估算 Moonshot token 数：汉字约 0.6 token/字，英文单词约 1.3 token/词，其余符号 0.5 token/个。
+
+    宁可略微高估，保证打包后的上下文不会超出模型窗口。
+    """
+    cjk = len(_CJK_RE.findall(text))
+    words = _WORD_RE.findall(text)
+    rest = len(text) - cjk - sum(len(w) for w in words) - text.count(" ")
+    return math.ceil(cjk * 0.6 + len(words) * 1.3 + max(rest, 0) * 0.5)
+
+
+def shingles(text, k=3):
+    text = "".join(text.split()).lower()
+    if len(text) <= k:
+        return {text}
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def score_pages(q, pages):
+    """按与问题的相关度打分 (片段集合内的 BM25 简化版)，返回按得分降序的 [(得分, 片段)]，得分相同时保持原顺序。"""
+    terms = set(query_terms(q))
+    docs = [Counter(tokenize(f"{p['name']} {p['snippet']}")) for p in pages]
+    lengths = [sum(d.values()) for d in docs]
+    n = len(docs)
+    avgdl = (sum(lengths) / n if n else 0.0) or 1.0
+    df = {t: sum(1 for d in docs if t in d) for t in terms}
+    scored = []
+    for i, (page, doc, dl) in enumerate(zip(pages, docs, lengths)):
+        score = 0.0
+        for t in terms:
+            tf = doc[t]
+            if tf:
+                idf = math.log(1 + (n - df[t] + 0.5) / (df[t] + 0.5))
+                score += idf * tf * 2.2 / (tf + 1.2 * (0.25 + 0.75 * dl / avgdl))
+        scored.append((-score, i, page))
+    scored.sort(key=lambda x: (x[0], x[1]))
+    return [(-neg, page) for neg, _, page in scored]
+
+
+def format_page(p):
+    return f"来源:{p['name']} 摘要:{p['snippet']}"
+
+
+def pack_context(q, pages, budget, dup_threshold=0.8, max_snippets=3, min_relevance=0.2):
+    """去除低相关和近似重复的片段，按相关度排序后贪心装入 budget 个 token、至多 max_snippets 条。
+
+    得分低于最高分 min_relevance 倍的片段 (包括与问题毫无词汇重合的) 直接丢弃；
+    所有片段都没有词汇重合时不做筛选，沿用搜索引擎给出的顺序。
+    返回 (资料文本, 估算的 token 数, 装入的片段数)。
+    """
+    scored = score_pages(q, pages)
+    top = scored[0][0] if scored else 0.0
+    # 每次请求只有十几个片段，直接比较 3-gram 集合的 Jaccard 相似度，比 MinHash 更快也更准
+    kept, seen = [], []
+    for score, page in scored:
+        if top > 0 and score < top * min_relevance:
+            break
+        sh = shingles(page["snippet"])
+        if any(jaccard(sh, other) >= dup_threshold for other in seen):
+            continue
+        kept.append(page)
+        seen.append(sh)
+
+    lines, used = [], 0
+    for page in kept:
+        if len(lines) >= max_snippets:
+            break
+        line = format_page(page)
+        cost = estimate_tokens(line) + 1
+        # 放不下就跳过，继续尝试后面更短的片段
+        if used + cost > budget:
+            continue
+        lines.append(line)
+        used += cost
+    return "\n".join(lines), used, len(lines)
+
+
+def choose_model(prompt_tokens, output_tokens):
+    """选出能容纳提示词和预期输出的最小档位模型，都放不下时用最大档。"""
+    for window, model in MODEL_TIERS:
+        if prompt_tokens + output_tokens <= window:
+            return model
+    return MODEL_TIERS[-1][1]
+
+
+class ContextPacker:
+    """上下文打包配置：CONTEXT_TOKEN_BUDGET 控制资料部分的 token 上限，CONTEXT_MAX_SNIPPETS 限制片段条数，
+    CONTEXT_MIN_RELEVANCE 是相对最高分的相关度下限，EXPECTED_OUTPUT_TOKENS 是选模型时为回答预留的 token 数。
+
+    默认最多 3 条片段，与原先固定取前 3 条相比提示词不会变长。"""
+
+    def __init__(self, budget=1500, output_tokens=1024, dup_threshold=0.8, max_snippets=3, min_relevance=0.2):
+        self.budget = budget
+        self.output_tokens = output_tokens
+        self.dup_threshold = dup_threshold
+        self.max_snippets = max_snippets
+        self.min_relevance = min_relevance
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", 1500)),
+            output_tokens=int(os.getenv("EXPECTED_OUTPUT_TOKENS", 1024)),
+            dup_threshold=float(os.getenv("CONTEXT_DUP_THRESHOLD", 0.8)),
+            max_snippets=int(os.getenv("CONTEXT_MAX_SNIPPETS", 3)),
+            min_relevance=float(os.getenv("CONTEXT_MIN_RELEVANCE", 0.2)),
+        )
+
+    def pack(self, q, pages):
+        return pack_context(q, pages, self.budget, self.dup_threshold, self.max_snippets, self.min_relevance)
+
+    def choose_model(self, prompt_tokens):
+        return choose_model(prompt_tokens, self.output_tokens)
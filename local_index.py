@@ -0,0 +1,374 @@
+import os
+import re
+import json
+import math
+import mmap
+import time
+import array
+import shutil
+import asyncio
+import logging
+import tempfile
+import threading
+import unicodedata
+from collections import Counter
+from html.parser import HTMLParser
+
+logger = logging.getLogger("ECUST_Assistant")
+
+DOC_EXTENSIONS = {".txt", ".md", ".markdown", ".html", ".htm"}
+PASSAGE_CHARS = 400
+INDEX_VERSION = 1
+# 指向当前索引版本目录的指针文件；超过 GC_AGE 秒的旧版本目录和残留临时文件会被清理
+CURRENT_FILE = "CURRENT"
+GC_AGE = 600.0
+
+# 英文/数字按词切分，中文按连续汉字切成字符二元组 (单字成段时保留单字)
+_TOKEN_RE = re.compile(r"[a-z0-9]+|[\u3400-\u4dbf\u4e00-\u9fff]+")
+
+
+# 提问时常用的疑问词和语气词，不表达检索意图；查询切词前替换成空格，
+# 既不参与打分，也不会和前后的字拼成"假什"、"候开"这类索引里不存在的二元组
+_QUESTION_RE = re.compile(
+    "什么时候|为什么|什么|怎么样|怎么|如何|有哪些|哪些|哪里|哪儿|哪个|哪几|几点|几号|多少|"
+    "是不是|有没有|是否|能否|可以|请问|吗|呢|吧|啊|的|是"
+)
+
+
+def tokenize(text):
+    tokens = []
+    for run in _TOKEN_RE.findall(unicodedata.normalize("NFKC", text).lower()):
+        if run.isascii():
+            tokens.append(run)
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def query_terms(q):
+    """切分查询：先去掉疑问词和语气词，再按 tokenize() 的规则切词。"""
+    return tokenize(_QUESTION_RE.sub(" ", unicodedata.normalize("NFKC", q)))
+
+
+class _HTMLText(HTMLParser):
+    """从 HTML 中提取正文和 <title>，忽略 script/style。"""
+
+    VOID_TAGS = {"br", "hr", "img", "meta", "link", "input", "area", "base", "col", "source", "wbr"}
+
+    def __init__(self):
+        super().__init__()
+        self.title = ""
+        self.parts = []
+        self._stack = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in self.VOID_TAGS:
+            self._stack.append(tag)
+        if tag in ("p", "br", "div", "li", "tr", "h1", "h2", "h3", "h4", "section"):
+            self.parts.append("\n\n")
+
+    def handle_endtag(self, tag):
+        if tag in self._stack:
+            while self._stack.pop() != tag:
+                pass
+
+    def handle_data(self, data):
+        current = self._stack[-1] if self._stack else ""
+        if current in ("script", "style"):
+            return
+        if current == "title":
+            self.title += data.strip()
+        else:
+            self.parts.append(data)
+
+
+def read_document(path):
+    """读取一个文档，返回 (标题, 正文)。"""
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        raw = f.read()
+    stem = os.path.splitext(os.path.basename(path))[0]
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".html", ".htm"):
+        parser = _HTMLText()
+        parser.feed(raw)
+        return parser.title or stem, "".join(parser.parts)
+    if ext in (".md", ".markdown"):
+        for line in raw.splitlines():
+            if line.startswith("# "):
+                return line[2:].strip(), raw
+    return stem, raw
+
+
+def split_passages(text, size=PASSAGE_CHARS):
+    """按空行切段，再把相邻短段合并到约 size 个字符，过长的段落硬切。"""
+    passages, current = [], ""
+    for para in re.split(r"\n\s*\n", text):
+        para = " ".join(para.split())
+        if not para:
+            continue
+        while len(para) > size:
+            if current:
+                passages.append(current)
+                current = ""
+            passages.append(para[:size])
+            para = para[size:]
+        if current and len(current) + len(para) + 1 > size:
+            passages.append(current)
+            current = ""
+        current = f"{current} {para}" if current else para
+    if current:
+        passages.append(current)
+    return passages
+
+
+class _Segment:
+    """一份只读的索引快照：mmap 的倒排表 + 词典 + 文档表。刷新时整体替换。"""
+
+    def __init__(self, meta, lexicon, postings_mm, generation):
+        self.meta = meta
+        self.generation = generation
+        self.docs = meta["docs"]
+        self.lexicon = lexicon
+        self.postings = memoryview(postings_mm).cast("I") if postings_mm is not None else memoryview(array.array("I"))
+        self.avgdl = meta["avgdl"] or 1.0
+
+    def posting_list(self, term):
+        entry = self.lexicon.get(term)
+        if entry is None:
+            return ()
+        start, df = entry
+        # 倒排表中每条记录占两个 uint32：(文档号, 词频)
+        return self.postings[start * 2:(start + df) * 2]
+
+
+class LocalIndex:
+    """校园文档的离线 BM25 检索引擎。
+
+    每个索引版本是一个 gen-* 目录，包含 meta.json (文件清单与段落表)、lexicon.json (词 -> 倒排表位置)
+    和 postings.bin (uint32 文档号/词频对)，后者在加载时通过 mmap 映射，不整体读入内存。
+    CURRENT 文件记录当前版本目录名。多个 worker 共用同一索引目录时，各自在私有临时目录里构建，
+    完成后重命名为新版本目录并原子替换 CURRENT，读取方总能看到一套完整一致的文件。
+    """
+
+    def __init__(self, index_dir, k1=1.5, b=0.75):
+        self.index_dir = index_dir
+        self.k1 = k1
+        self.b = b
+        self._segment = None
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.index_dir, name)
+
+    @property
+    def size(self):
+        return len(self._segment.docs) if self._segment else 0
+
+    def _current(self):
+        try:
+            with open(self._path(CURRENT_FILE), encoding="utf-8") as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def load(self):
+        """从磁盘加载 CURRENT 指向的索引版本，成功 (或已是该版本) 返回 True。"""
+        generation = self._current()
+        if generation is None:
+            return False
+        if self._segment is not None and self._segment.generation == generation:
+            return True
+        gen_dir = self._path(generation)
+        try:
+            with open(os.path.join(gen_dir, "meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("version") != INDEX_VERSION:
+                return False
+            with open(os.path.join(gen_dir, "lexicon.json"), encoding="utf-8") as f:
+                lexicon = json.load(f)
+            mm = None
+            postings_path = os.path.join(gen_dir, "postings.bin")
+            if os.path.getsize(postings_path) > 0:
+                with open(postings_path, "rb") as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        # 旧快照可能仍在其他线程的查询中使用，交给垃圾回收关闭其 mmap
+        self._segment = _Segment(meta, lexicon, mm, generation)
+        return True
+
+    def _scan(self, docs_dir):
+        files = {}
+        for root, _, names in os.walk(docs_dir):
+            for name in names:
+                if os.path.splitext(name)[1].lower() in DOC_EXTENSIONS:
+                    path = os.path.join(root, name)
+                    st = os.stat(path)
+                    files[os.path.relpath(path, docs_dir)] = [st.st_mtime, st.st_size]
+        return files
+
+    def refresh(self, docs_dir):
+        """增量重建：只重新读取和切词新增/修改过的文件，其余段落的词频从现有倒排表还原。
+
+        没有变化时直接返回 False，否则写入新索引并切换过去，返回 True。
+        """
+        with self._lock:
+            # 其他 worker 可能已经发布了更新的版本，先切换过去再比较，避免重复构建
+            self.load()
+            old = self._segment
+            old_files = old.meta["files"] if old else {}
+            files = self._scan(docs_dir)
+            changed = [rel for rel, stat in files.items() if old_files.get(rel, {}).get("stat") != stat]
+            if not changed and set(files) == set(old_files):
+                return False
+
+            # 还原未变化文件的段落词频 (倒排表 -> 正排表)
+            keep = {rel for rel in files if rel not in changed and rel in old_files}
+            forward = {}
+            if old is not None:
+                keep_ids = {i for rel in keep for i in old_files[rel]["docs"]}
+                for term, (start, df) in old.lexicon.items():
+                    plist = old.postings[start * 2:(start + df) * 2]
+                    for j in range(0, len(plist), 2):
+                        if plist[j] in keep_ids:
+                            forward.setdefault(plist[j], {})[term] = plist[j + 1]
+
+            docs, tfs, new_files = [], [], {}
+            for rel in sorted(files):
+                ids = []
+                if rel in keep:
+                    for old_id in old_files[rel]["docs"]:
+                        ids.append(len(docs))
+                        docs.append(old.docs[old_id])
+                        tfs.append(forward.get(old_id, {}))
+                else:
+                    title, text = read_document(os.path.join(docs_dir, rel))
+                    for passage in split_passages(text):
+                        tokens = tokenize(f"{title} {passage}")
+                        if not tokens:
+                            continue
+                        ids.append(len(docs))
+                        docs.append({"name": title, "path": rel, "text": passage, "len": len(tokens)})
+                        tfs.append(Counter(tokens))
+                new_files[rel] = {"stat": files[rel], "docs": ids}
+
+            self._write(docs, tfs, new_files)
+            self.load()
+            logger.info(f"本地索引已更新: {len(changed)} 个文件变化，共 {len(docs)} 个段落")
+            return True
+
+    def _write(self, docs, tfs, files):
+        os.makedirs(self.index_dir, exist_ok=True)
+        inverted = {}
+        for doc_id, tf in enumerate(tfs):
+            for term, count in tf.items():
+                inverted.setdefault(term, []).append((doc_id, count))
+
+        postings = array.array("I")
+        lexicon = {}
+        for term in sorted(inverted):
+            plist = inverted[term]
+            lexicon[term] = [len(postings) // 2, len(plist)]
+            for doc_id, count in plist:
+                postings.append(doc_id)
+                postings.append(count)
+
+        total = sum(d["len"] for d in docs)
+        meta = {"version": INDEX_VERSION, "avgdl": total / len(docs) if docs else 0.0,
+                "files": files, "docs": docs}
+        # 在私有临时目录中写完整套文件，再重命名为版本目录并原子替换 CURRENT；
+        # 并发构建的 worker 互不干扰，正在使用旧 mmap 的查询也不受影响
+        build_dir = tempfile.mkdtemp(prefix=".build-", dir=self.index_dir)
+        try:
+            with open(os.path.join(build_dir, "postings.bin"), "wb") as f:
+                postings.tofile(f)
+            with open(os.path.join(build_dir, "lexicon.json"), "wb") as f:
+                f.write(json.dumps(lexicon, ensure_ascii=False).encode("utf-8"))
+            with open(os.path.join(build_dir, "meta.json"), "wb") as f:
+                f.write(json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+            generation = f"gen-{time.time_ns()}-{os.getpid()}"
+            os.rename(build_dir, self._path(generation))
+        except BaseException:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            raise
+
+        fd, tmp = tempfile.mkstemp(prefix=".current-", dir=self.index_dir)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(generation)
+        os.replace(tmp, self._path(CURRENT_FILE))
+        self._collect(generation)
+
+    def _collect(self, keep):
+        """删除过旧的版本目录和残留的临时文件。
+
+        只删除超过 GC_AGE 的条目，其他 worker 刚构建好、还没来得及发布的版本不会被误删；
+        已被 mmap 的文件在 POSIX 上删除后仍可继续读取。
+        """
+        cutoff = time.time() - GC_AGE
+        for name in os.listdir(self.index_dir):
+            if name == keep or not name.startswith(("gen-", ".build-", ".current-")):
+                continue
+            path = self._path(name)
+            try:
+                if os.path.getmtime(path) > cutoff:
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def search(self, q, top_k=3):
+        """BM25 检索，返回按得分排序的段落列表。
+
+        每个结果带 score (BM25 原始分) 和 match (0~1，按查询词 idf 归一化后的得分，
+        用于和固定阈值比较)。
+        """
+        seg = self._segment
+        if seg is None or not seg.docs:
+            return []
+        n = len(seg.docs)
+        scores = Counter()
+        idfs, missing = [], 0
+        for term in set(query_terms(q)):
+            plist = seg.posting_list(term)
+            df = len(plist) // 2
+            if df == 0:
+                missing += 1
+                continue
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            idfs.append(idf)
+            for j in range(0, len(plist), 2):
+                doc_id, tf = plist[j], plist[j + 1]
+                dl = seg.docs[doc_id]["len"]
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * dl / seg.avgdl))
+        # 不在索引中的词也计入分母，避免只命中一两个字就被判为高分；但按已命中词的平均 idf 计，
+        # 而不是最大 idf，否则跨词拼出的二元组等噪声会把真正相关的段落压成低分
+        idf_total = sum(idfs) + missing * (sum(idfs) / len(idfs) if idfs else 0.0)
+
+        results = []
+        for doc_id, score in scores.most_common(top_k):
+            doc = seg.docs[doc_id]
+            results.append({
+                "name": doc["name"],
+                "url": f"local:{doc['path']}",
+                "snippet": doc["text"],
+                "score": score,
+                "match": min(1.0, score / idf_total) if idf_total else 0.0,
+            })
+        return results
+
+    async def asearch(self, q, top_k=3):
+        return await asyncio.to_thread(self.search, q, top_k)
+
+    async def watch(self, docs_dir, interval):
+        """定期检查文档目录并增量更新索引。"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.refresh, docs_dir)
+            except Exception as e:
+                logger.error(f"本地索引更新失败: {e}")
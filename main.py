@@ -1,22 +1,112 @@
 import os
+import json
+import time
+import asyncio
+from typing import List, Optional
 import logging
-from fastapi import FastAPI, Query
-from fastapi.responses import HTMLResponse
-import httpx
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Query, Request, Header, HTTPException, Depends
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+from sse_starlette.sse import EventSourceResponse
 import uvicorn
 
+from upstream import UpstreamPool
+from search_cache import SearchCache, normalize_query
+from answer_cache import AnswerCache, ERROR_PREFIXES
+from local_index import LocalIndex, query_terms
+from context_pack import ContextPacker, estimate_tokens, jaccard
+from metrics import REGISTRY, MetricsMiddleware, timed, record_usage, begin_request
+from admission import Overloaded, remaining, reserve_time, set_deadline
+
 # --- 配置日志 ---
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("ECUST_Assistant")
 
-app = FastAPI()
-
 # --- 环境变量 (请在 Zeabur 重新配置) ---
 # 1. Moonshot API Key (从 platform.moonshot.cn 获取)
 MOONSHOT_API_KEY = os.getenv("MOONSHOT_API_KEY")
 # 2. Bocha API Key (从 open.bochaai.com 获取，国产搜索首选)
 BOCHA_API_KEY = os.getenv("BOCHA_API_KEY")
 
+# --- 上游客户端 (整个进程共享连接池，超时/重试/熔断见 upstream.py，并发/限速见 admission.py) ---
+upstreams = UpstreamPool.from_env(BOCHA_API_KEY, MOONSHOT_API_KEY)
+# 每个请求排队等待上游的最长时间，超过就直接返回繁忙
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", 20))
+# 联网搜索在请求截止前还要额外给 Moonshot 排队/限速留出的秒数 (在其 reserve 之外)
+SEARCH_HEADROOM = float(os.getenv("SEARCH_HEADROOM", 1.0))
+
+# --- 批量提问 (/chat/batch) ---
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 16))
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", 500))
+# 检索词 Jaccard 相似度不低于该值的问题共用一次检索 (联网搜索 + 本地检索 + 上下文打包)
+BATCH_SHARE_THRESHOLD = float(os.getenv("BATCH_SHARE_THRESHOLD", 0.6))
+
+# --- 搜索缓存 (SEARCH_CACHE_BACKEND=sqlite 时多个 worker 共享，TTL 默认随 freshness 变化) ---
+SEARCH_FRESHNESS = os.getenv("BOCHA_FRESHNESS", "noLimit")
+search_cache = SearchCache.from_env()
+
+# --- 回答缓存 (stale-while-revalidate，管理接口需在请求头 X-Admin-Token 中携带 ADMIN_TOKEN) ---
+answer_cache = AnswerCache.from_env()
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# --- 本地校园知识库 (LOCAL_DOCS_DIR 下的 txt/md/html，未配置时不启用) ---
+LOCAL_DOCS_DIR = os.getenv("LOCAL_DOCS_DIR")
+LOCAL_INDEX_TOP_K = int(os.getenv("LOCAL_INDEX_TOP_K", 3))
+# 本地最高分 (0~1) 达到该值时跳过联网搜索
+LOCAL_INDEX_SKIP_SCORE = float(os.getenv("LOCAL_INDEX_SKIP_SCORE", 0.8))
+LOCAL_INDEX_HEAD_START = float(os.getenv("LOCAL_INDEX_HEAD_START", 0.05))
+LOCAL_INDEX_REFRESH = float(os.getenv("LOCAL_INDEX_REFRESH", 300))
+local_index = LocalIndex(os.getenv("LOCAL_INDEX_DIR", ".local_index"))
+
+# --- 上下文打包 (CONTEXT_TOKEN_BUDGET 控制资料 token 上限，按长度自动选 8k/32k/128k 模型) ---
+context_packer = ContextPacker.from_env()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await upstreams.start()
+    watcher = None
+    if LOCAL_DOCS_DIR:
+        await asyncio.to_thread(local_index.refresh, LOCAL_DOCS_DIR)
+        logger.info(f"本地知识库已加载: {local_index.size} 个段落")
+        if LOCAL_INDEX_REFRESH > 0:
+            watcher = asyncio.create_task(local_index.watch(LOCAL_DOCS_DIR, LOCAL_INDEX_REFRESH))
+    try:
+        yield
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        await upstreams.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+# 为 /chat 系列接口统计在途请求、端到端延迟并添加 Server-Timing 响应头
+app.add_middleware(MetricsMiddleware, paths=("/chat", "/chat/stream", "/chat/batch"))
+
+
+def collect_state():
+    """把缓存、熔断器、本地索引的状态导出为 /metrics 中的指标。"""
+    caches = {"search": search_cache.snapshot(), "answer": answer_cache.snapshot()}
+    families = [
+        ("ecust_cache_events_total", "counter", "Cache lookups by cache and result.",
+         {(("cache", name), ("result", k)): v for name, snap in caches.items()
+          for k, v in snap.items() if k in ("hits", "stale_hits", "misses", "coalesced", "refreshes")}),
+        ("ecust_cache_entries", "gauge", "Entries currently stored in each cache.",
+         {(("cache", name),): snap["size"] for name, snap in caches.items()}),
+        ("ecust_local_index_passages", "gauge", "Passages in the local knowledge index.",
+         {(): local_index.size}),
+    ]
+    breaker = upstreams.bocha.breaker
+    if breaker is not None:
+        families.append(("ecust_circuit_open", "gauge", "1 when the upstream circuit breaker is not closed.",
+                         {(("upstream", "bocha"),): int(breaker.state != "closed")}))
+    return families
+
+
+REGISTRY.add_collector(collect_state)
+
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="zh-CN">
@@ -52,19 +142,39 @@ HTML_TEMPLATE = """
     </div>
 </div>
 <script>
-    async function sendMessage() {
+    function sendMessage() {
         const input = document.getElementById('userInput');
         const text = input.value.trim();
         if(!text) return;
         append('user-message', text);
         input.value = '';
         const lId = append('ai-message', '正在通过国内信源检索资料...', true);
+        const box = document.getElementById(lId);
+        if (!window.EventSource) return sendMessageOnce(text, box);
+
+        // 逐 token 渲染：先显示检索进度，收到第一个 token 后替换为正文
+        const es = new EventSource(`/chat/stream?q=${encodeURIComponent(text)}`);
+        let answer = '';
+        es.addEventListener('search_done', () => { box.innerText = '资料检索完成，正在生成回答...'; });
+        es.addEventListener('token', (e) => {
+            answer += JSON.parse(e.data).delta;
+            box.innerText = answer;
+            document.getElementById('chat-window').scrollTop = 99999;
+        });
+        es.addEventListener('done', () => es.close());
+        es.addEventListener('error', (e) => {
+            es.close();
+            const msg = e.data ? JSON.parse(e.data).message : "❌ 连接失败，请检查 API 配置。";
+            box.innerText = answer ? answer + "\\n\\n" + msg : msg;
+        });
+    }
+    async function sendMessageOnce(text, box) {
         try {
             const res = await fetch(`/chat?q=${encodeURIComponent(text)}`);
             const data = await res.json();
-            document.getElementById(lId).innerText = data.answer;
+            box.innerText = data.answer;
         } catch (e) {
-            document.getElementById(lId).innerText = "❌ 连接失败，请检查 API 配置。";
+            box.innerText = "❌ 连接失败，请检查 API 配置。";
         }
     }
     function append(cls, txt, isL=false) {
@@ -87,56 +197,366 @@ async def home():
     return HTML_TEMPLATE
 
 
+CONFIG_ERROR = "🔧 环境变量未配置。请确保 MOONSHOT_API_KEY 和 BOCHA_API_KEY 已填入 Zeabur。"
+BUSY_MESSAGE = "⚠️ 系统繁忙：当前提问人数较多，请稍后再试。"
+
+
+async def fetch_pages(q):
+    """调用 Bocha 搜索，返回网页列表；失败时返回 None (不会被缓存)。"""
+    try:
+        # Bocha API 参考：https://open.bochaai.com/
+        bocha_res = await upstreams.bocha.post(
+            "/v1/web-search",
+            json={
+                "query": q,
+                "freshness": SEARCH_FRESHNESS,  # 搜索时效性
+                "summary": True
+            },
+            idempotent=True,
+        )
+        if bocha_res.status_code == 200:
+            data = bocha_res.json()
+            # 提取搜索到的网页摘要
+            pages = data.get("data", {}).get("webPages", {}).get("value", [])
+            logger.info("Bocha 搜索成功")
+            return [{"name": p["name"], "url": p.get("url", ""), "snippet": p["snippet"]} for p in pages]
+        logger.error(f"Bocha 搜索失败: HTTP {bocha_res.status_code}")
+    except Exception as e:
+        logger.error(f"Bocha 搜索失败: {e}")
+    return None
+
+
+async def search_web(q):
+    """使用 Bocha AI 进行中文联网搜索 (带缓存)，失败或超出搜索时间预算时返回空列表。
+
+    搜索的截止时间比请求截止时间提前 Moonshot 的 reserve 加 SEARCH_HEADROOM 秒，
+    保证搜索再慢也不会挤掉生成回答的时间。
+    """
+    gate = upstreams.moonshot.gate
+    with reserve_time((gate.reserve if gate is not None else 0.0) + SEARCH_HEADROOM):
+        left = remaining()
+        try:
+            pages = await asyncio.wait_for(
+                search_cache.get_or_fetch(q, SEARCH_FRESHNESS, lambda: fetch_pages(q)),
+                timeout=None if left is None else max(left, 0.0))
+        except asyncio.TimeoutError:
+            # 搜索只是锦上添花：来不及就不带搜索结果回答，后台的请求完成后仍会写入缓存
+            logger.warning("Bocha 搜索超出时间预算，不带搜索结果继续回答")
+            return []
+    return pages or []
+
+
+async def search_local(q):
+    """检索本地知识库，失败时返回空列表 (本地库只是补充来源，不能让整个请求失败)。"""
+    try:
+        return await local_index.asearch(q, LOCAL_INDEX_TOP_K)
+    except Exception as e:
+        logger.error(f"本地知识库检索失败: {e}")
+        return []
+
+
+def merge_pages(local_hits, web_pages):
+    """本地结果在前、联网结果在后，按链接和摘要去重。"""
+    merged, seen = [], set()
+    for p in local_hits + web_pages:
+        key = p.get("url") or p["snippet"]
+        if key in seen or p["snippet"] in seen:
+            continue
+        seen.update((key, p["snippet"]))
+        merged.append(p)
+    return merged
+
+
+async def retrieve(q):
+    """并行检索本地知识库和 Bocha，返回 (打包后的资料文本, 选用的模型)。
+
+    本地检索先行一小段时间 (LOCAL_INDEX_HEAD_START)，若已有足够高分的命中就不再联网搜索。
+    资料按相关度去重排序后装入 CONTEXT_TOKEN_BUDGET，再选能放下提示词和回答的最小档模型。
+    """
+    with timed("search"):
+        local_task = asyncio.ensure_future(search_local(q))
+        done, _ = await asyncio.wait({local_task}, timeout=LOCAL_INDEX_HEAD_START)
+        if done and local_task.result() and local_task.result()[0]["match"] >= LOCAL_INDEX_SKIP_SCORE:
+            logger.info("本地知识库命中，跳过联网搜索")
+            pages = local_task.result()
+        else:
+            web_pages, local_hits = await asyncio.gather(search_web(q), local_task)
+            pages = merge_pages(local_hits, web_pages)
+
+    with timed("pack"):
+        search_context, _, packed = context_packer.pack(q, pages)
+        prompt_tokens = estimate_tokens(system_prompt(search_context)) + estimate_tokens(q)
+        model = context_packer.choose_model(prompt_tokens)
+    logger.info(f"上下文打包: {packed}/{len(pages)} 条资料，提示词约 {prompt_tokens} tokens，模型 {model}")
+    return search_context, model
+
+
+def system_prompt(search_context):
+    return f"你是一个华理校园专家。基于以下搜索到的最新信息回答。如果没有相关资料，请结合常识回答。资料：{search_context}"
+
+
+def build_payload(q, search_context, model, stream=False):
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt(search_context)},
+            {"role": "user", "content": q}
+        ],
+        "temperature": 0.3
+    }
+    if stream:
+        payload["stream"] = True
+    return payload
+
+
+def api_error(status_code):
+    return f"❌ API 错误 (代码: {status_code})。请确认 Moonshot API Key 是否有效。"
+
+
+async def ask_moonshot(q, search_context, model):
+    """使用 Moonshot (Kimi) 整合回答，出错时返回以 ❌/⚠️ 开头的提示文本。"""
+    try:
+        with timed("llm_total"):
+            response = await upstreams.moonshot.post("/v1/chat/completions", json=build_payload(q, search_context, model))
+
+        if response.status_code == 200:
+            data = response.json()
+            record_usage(model, data.get("usage"))
+            return data['choices'][0]['message']['content']
+        else:
+            return api_error(response.status_code)
+    except Overloaded:
+        return BUSY_MESSAGE
+    except Exception as e:
+        return f"⚠️ 系统繁忙: {str(e)}"
+
+
+async def answer_question(q):
+    """完整的问答流程 (检索 -> 回答缓存 -> Moonshot)。"""
+    # --- 1. 使用 Bocha AI 进行中文联网搜索 ---
+    search_context, model = await retrieve(q)
+    return await answer_with_context(q, search_context, model)
+
+
+async def answer_with_context(q, search_context, model):
+    """基于已检索的资料回答问题 (回答缓存 -> Moonshot)，/chat 和 /chat/batch 共用。"""
+    # --- 2. 先查回答缓存，陈旧条目直接返回并在后台刷新 ---
+    cache_key = AnswerCache.make_key(q, search_context, model)
+    answer = await answer_cache.get(cache_key, refresh=lambda: ask_moonshot(q, search_context, model))
+    if answer is not None:
+        return answer
+
+    # --- 3. 使用 Moonshot (Kimi) 整合回答 ---
+    answer = await ask_moonshot(q, search_context, model)
+    await answer_cache.put(cache_key, answer)
+    return answer
+
+
 @app.get("/chat")
 async def chat(q: str = Query(...)):
     if not MOONSHOT_API_KEY or not BOCHA_API_KEY:
-        return {"answer": "🔧 环境变量未配置。请确保 MOONSHOT_API_KEY 和 BOCHA_API_KEY 已填入 Zeabur。"}
+        return {"answer": CONFIG_ERROR}
+    set_deadline(REQUEST_DEADLINE)
+    return {"answer": await answer_question(q)}
+
+
+class BatchRequest(BaseModel):
+    questions: List[str]
+    # 同时处理的问题数，不填时使用 BATCH_CONCURRENCY
+    concurrency: Optional[int] = None
+
+
+def cluster_questions(questions, threshold):
+    """把检索词高度重合的问题聚成一簇：与簇内第一个问题的 Jaccard 相似度 >= threshold。
+
+    检索词按 query_terms() 切分，"华理寒假什么时候放假" 和 "华理寒假几号放假" 会落在同一簇。
+    返回每簇问题在 questions 中的下标列表。
+    """
+    clusters = []
+    for i, q in enumerate(questions):
+        terms = set(query_terms(q))
+        for head, members in clusters:
+            if jaccard(terms, head) >= threshold:
+                members.append(i)
+                break
+        else:
+            clusters.append((terms, [i]))
+    return [members for _, members in clusters]
+
+
+async def answer_batch_item(q, shared_retrieve):
+    """回答批量请求中的一个问题，返回 (回答, 错误信息, 各阶段耗时毫秒)。
+
+    shared_retrieve() 返回本簇共用的检索任务，只有第一个用到它的问题会真正执行检索并计入 search 耗时。
+    """
+    timings = begin_request()
+    start = time.perf_counter()
+    # 截止时间从真正开始处理时算起，不包括在批内排队的时间
+    set_deadline(REQUEST_DEADLINE)
+    try:
+        # shield：某个问题被取消时，不影响同簇其他问题等待同一个检索结果
+        search_context, model = await asyncio.shield(shared_retrieve())
+        answer = await answer_with_context(q, search_context, model)
+        error = answer if answer.startswith(ERROR_PREFIXES) else None
+    except Exception as e:
+        answer, error = None, f"⚠️ 系统繁忙: {str(e)}"
+    timings["total"] = time.perf_counter() - start
+    return answer, error, {stage: round(sec * 1000, 1) for stage, sec in timings.items()}
+
+
+@app.post("/chat/batch")
+async def chat_batch(body: BatchRequest):
+    """批量提问，按完成顺序以 NDJSON 逐行返回：{"index", "question", "answer", "error", "timings_ms"}。
+
+    归一化后相同的问题只跑一次流程，结果分发给每个对应的 index；检索词重合度达到
+    BATCH_SHARE_THRESHOLD 的不同问题共用一次检索 (以簇内第一个问题检索)，但各自生成回答。
+    """
+    if not MOONSHOT_API_KEY or not BOCHA_API_KEY:
+        raise HTTPException(status_code=503, detail=CONFIG_ERROR)
+    if len(body.questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=413, detail=f"一次最多 {BATCH_MAX_QUESTIONS} 个问题")
 
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        # --- 1. 使用 Bocha AI 进行中文联网搜索 ---
-        search_context = ""
+    groups = {}
+    for i, q in enumerate(body.questions):
+        groups.setdefault(normalize_query(q), []).append(i)
+    group_list = list(groups.values())
+    cluster_of = {}
+    for c, members in enumerate(cluster_questions([body.questions[g[0]] for g in group_list], BATCH_SHARE_THRESHOLD)):
+        for g in members:
+            cluster_of[g] = (c, body.questions[group_list[members[0]][0]])
+    limit = max(1, min(body.concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+    semaphore = asyncio.Semaphore(limit)
+    retrievals = {}
+
+    def shared_retrieve(g):
+        # 簇内第一个开始处理的问题创建检索任务，同簇其他问题复用
+        c, head = cluster_of[g]
+        task = retrievals.get(c)
+        if task is None:
+            task = retrievals[c] = asyncio.ensure_future(retrieve(head))
+        return task
+
+    async def run(g):
+        indices = group_list[g]
+        async with semaphore:
+            return indices, await answer_batch_item(body.questions[indices[0]], lambda: shared_retrieve(g))
+
+    async def lines():
+        tasks = [asyncio.ensure_future(run(g)) for g in range(len(group_list))]
         try:
-            # Bocha API 参考：https://open.bochaai.com/
-            bocha_res = await client.post(
-                "https://api.bochaai.com/v1/web-search",
-                headers={"Authorization": f"Bearer {BOCHA_API_KEY}"},
-                json={
-                    "query": q,
-                    "freshness": "noLimit",  # 搜索时效性
-                    "summary": True
-                }
-            )
-            if bocha_res.status_code == 200:
-                data = bocha_res.json()
-                # 提取搜索到的网页摘要
-                pages = data.get("data", {}).get("webPages", {}).get("value", [])
-                search_context = "\n".join([f"来源:{p['name']} 摘要:{p['snippet']}" for p in pages[:3]])
-                logger.info("Bocha 搜索成功")
-        except Exception as e:
-            logger.error(f"Bocha 搜索失败: {e}")
+            for next_done in asyncio.as_completed(tasks):
+                indices, (answer, error, timings) = await next_done
+                for i in indices:
+                    yield json.dumps({"index": i, "question": body.questions[i], "answer": answer,
+                                      "error": error, "timings_ms": timings}, ensure_ascii=False) + "\n"
+        finally:
+            # 客户端中途断开时取消尚未完成的问题和检索
+            for task in tasks + list(retrievals.values()):
+                task.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
-        # --- 2. 使用 Moonshot (Kimi) 整合回答 ---
+
+def require_admin(x_admin_token: str = Header(None)):
+    # 未配置 ADMIN_TOKEN 时管理接口整体关闭
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="forbidden")
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {"search": search_cache.snapshot(), "answer": answer_cache.snapshot()}
+
+
+@app.post("/admin/cache/purge", dependencies=[Depends(require_admin)])
+async def purge_answers(prefix: str = Query(...)):
+    """删除问题以 prefix 开头的回答缓存。"""
+    return {"purged": await answer_cache.purge(prefix)}
+
+
+@app.post("/admin/cache/invalidate", dependencies=[Depends(require_admin)])
+async def invalidate_answers():
+    return {"purged": await answer_cache.invalidate_all()}
+
+
+async def stream_moonshot(q, search_context, model):
+    """调用 chat/completions (stream=true)，逐个产出增量文本。
+
+    调用方停止迭代 (例如客户端断开) 时，async with 会关闭上游连接，不再继续消耗 token。
+    """
+    with timed("llm_total"):
+        async with upstreams.moonshot.stream("/v1/chat/completions",
+                                             json=build_payload(q, search_context, model, stream=True)) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise RuntimeError(api_error(response.status_code))
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                choice = chunk["choices"][0]
+                # Moonshot 在最后一个分片里返回 usage (位于 choice 内或顶层)
+                record_usage(model, chunk.get("usage") or choice.get("usage"))
+                delta = choice.get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+
+def sse(event, **data):
+    return {"event": event, "data": json.dumps(data, ensure_ascii=False)}
+
+
+@app.get("/chat/stream")
+async def chat_stream(request: Request, q: str = Query(...)):
+    """与 /chat 相同的流程，但以 SSE 逐步推送：search_start -> search_done -> token... -> done。"""
+
+    async def events():
+        if not MOONSHOT_API_KEY or not BOCHA_API_KEY:
+            yield sse("error", message=CONFIG_ERROR)
+            return
+        set_deadline(REQUEST_DEADLINE)
+
+        yield sse("search_start")
+        search_context, model = await retrieve(q)
+        yield sse("search_done", found=bool(search_context))
+
+        cache_key = AnswerCache.make_key(q, search_context, model)
+        answer = await answer_cache.get(cache_key, refresh=lambda: ask_moonshot(q, search_context, model))
+        if answer is not None:
+            yield sse("token", delta=answer)
+            yield sse("done", cached=True)
+            return
+
+        parts = []
         try:
-            response = await client.post(
-                "https://api.moonshot.cn/v1/chat/completions",
-                headers={"Authorization": f"Bearer {MOONSHOT_API_KEY}"},
-                json={
-                    "model": "moonshot-v1-8k",
-                    "messages": [
-                        {"role": "system",
-                         "content": f"你是一个华理校园专家。基于以下搜索到的最新信息回答。如果没有相关资料，请结合常识回答。资料：{search_context}"},
-                        {"role": "user", "content": q}
-                    ],
-                    "temperature": 0.3
-                }
-            )
-
-            if response.status_code == 200:
-                return {"answer": response.json()['choices'][0]['message']['content']}
-            else:
-                return {"answer": f"❌ API 错误 (代码: {response.status_code})。请确认 Moonshot API Key 是否有效。"}
+            async for delta in stream_moonshot(q, search_context, model):
+                if await request.is_disconnected():
+                    logger.info("客户端已断开，取消上游生成")
+                    return
+                parts.append(delta)
+                yield sse("token", delta=delta)
+        except RuntimeError as e:
+            yield sse("error", message=str(e))
+            return
+        except Overloaded:
+            yield sse("error", message=BUSY_MESSAGE)
+            return
         except Exception as e:
-            return {"answer": f"⚠️ 系统繁忙: {str(e)}"}
+            yield sse("error", message=f"⚠️ 系统繁忙: {str(e)}")
+            return
+        # 只有完整生成的回答才写入缓存
+        await answer_cache.put(cache_key, "".join(parts))
+        yield sse("done")
+
+    return EventSourceResponse(events())
 
 
 if __name__ == "__main__":
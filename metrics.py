@@ -0,0 +1,248 @@
+import time
+import bisect
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# 默认的延迟分桶 (秒)，覆盖本地缓存命中到上游 60s 超时
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _default(self):
+        # 无标签的指标直接在自身上调用 inc()/observe()
+        return self.labels()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{_format_labels(self.label_names, values)} {_format_value(child.value)}"]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+    def set(self, value):
+        self._default().set(value)
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def _render_child(self, values, child):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+            cumulative += count
+            labels = _format_labels(self.label_names, values, [("le", _format_value(float(bound)))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.label_names, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Registry:
+    """收集所有指标并输出 Prometheus 文本格式。
+
+    collector 是返回 [(名称, 类型, 说明, {标签元组: 值})] 的函数，用于导出
+    缓存命中数这类已经在别处统计好的数值，抓取时才读取。
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, kind, help, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples.items():
+                    label_text = "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}" if labels else ""
+                    lines.append(f"{name}{label_text} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "ecust_stage_seconds", "Latency of each /chat pipeline stage.", labels=("stage",)))
+UPSTREAM_RESPONSES = REGISTRY.register(Counter(
+    "ecust_upstream_responses_total", "Upstream HTTP responses by status code.", labels=("upstream", "status")))
+UPSTREAM_ERRORS = REGISTRY.register(Counter(
+    "ecust_upstream_errors_total", "Upstream transport errors (timeouts, connection failures).",
+    labels=("upstream", "kind")))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "ecust_request_seconds", "End-to-end latency of each request, by endpoint.", labels=("endpoint",)))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    "ecust_requests_in_flight", "Requests currently being served.", labels=("endpoint",)))
+LLM_TOKENS = REGISTRY.register(Counter(
+    "ecust_llm_tokens_total", "Token usage reported by Moonshot.", labels=("model", "kind")))
+
+# --- 单次请求内的分阶段计时，用于 Server-Timing 响应头 ---
+_timings = ContextVar("ecust_timings", default=None)
+
+
+def begin_request():
+    timings = {}
+    _timings.set(timings)
+    return timings
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def record_usage(model, usage):
+    if usage:
+        LLM_TOKENS.labels(model, "prompt").inc(usage.get("prompt_tokens", 0))
+        LLM_TOKENS.labels(model, "completion").inc(usage.get("completion_tokens", 0))
+
+
+def server_timing(timings):
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+class MetricsMiddleware:
+    """纯 ASGI 中间件：统计在途请求数和端到端延迟，并在响应头中加上 Server-Timing。
+
+    流式响应的响应头在生成开始前就已发出，其 Server-Timing 只包含此前完成的阶段。
+    """
+
+    def __init__(self, app, paths=("/chat", "/chat/stream")):
+        self.app = app
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+
+        timings = begin_request()
+        start = time.perf_counter()
+        endpoint = scope["path"]
+        gauge = IN_FLIGHT.labels(endpoint)
+        gauge.inc()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                entries = {**timings, "total": time.perf_counter() - start}
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(entries).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            gauge.dec()
+            # 按接口分开统计：/chat/stream 的长连接和 /chat/batch 的整批耗时不能和 /chat 混在一起
+            REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
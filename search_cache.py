@@ -0,0 +1,230 @@
+import os
+import re
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger("ECUST_Assistant")
+
+# Bocha freshness 取值对应的默认缓存时长 (秒)：要求越新的搜索，缓存越短
+FRESHNESS_TTL = {
+    "oneDay": 600,
+    "oneWeek": 3600,
+    "oneMonth": 6 * 3600,
+    "oneYear": 24 * 3600,
+    "noLimit": 24 * 3600,
+}
+
+_CJK_SPACE = re.compile(r"(?<=[^\x00-\x7f]) | (?=[^\x00-\x7f])")
+
+
+def normalize_query(q):
+    """归一化查询：全角转半角、统一大小写、去掉标点、合并空白 (中文字符两侧的空白直接去掉)。"""
+    q = unicodedata.normalize("NFKC", q).lower()
+    q = "".join(" " if unicodedata.category(ch).startswith("P") else ch for ch in q)
+    return _CJK_SPACE.sub("", " ".join(q.split()))
+
+
+class MemoryBackend:
+    """进程内 LRU 缓存，默认后端。"""
+
+    # 纯内存操作，直接在事件循环里调用
+    blocking = False
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires <= time.time():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl):
+        self._data[key] = (value, time.time() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete_prefix(self, prefix):
+        keys = [k for k in self._data if k.startswith(prefix)]
+        for k in keys:
+            del self._data[k]
+        return len(keys)
+
+    def clear(self):
+        n = len(self._data)
+        self._data.clear()
+        return n
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteBackend:
+    """基于 SQLite 文件的缓存，多个 uvicorn worker 指向同一文件即可共享条目。
+
+    所有方法都是阻塞的，由 call_backend() 放到线程池里执行。其他 worker 长时间持有写锁时
+    最多等待 busy_timeout 秒，之后按未命中 / 不写入处理 (fail open)，不让缓存拖慢请求。
+    """
+
+    blocking = True
+
+    def __init__(self, path, maxsize=10000, busy_timeout=0.2):
+        self.path = path
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        # WAL 模式下读写互不阻塞，适合多进程共享
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        # 命中时只在内存里记下访问时间，下次写入时再批量更新，读操作不产生写事务
+        self._touched = {}
+        self._size = self._count()
+
+    def _count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get(self, key):
+        now = time.time()
+        try:
+            with self._lock:
+                row = self._conn.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        except sqlite3.OperationalError as e:
+            logger.warning(f"SQLite 缓存读取失败，按未命中处理: {e}")
+            return None
+        # 过期条目留到下次写入时统一清理
+        if row is None or row[1] <= now:
+            return None
+        self._touched[key] = now
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        touched, self._touched = self._touched, {}
+        try:
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._conn.executemany("UPDATE cache SET accessed = ? WHERE key = ?",
+                                           [(t, k) for k, t in touched.items()])
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+                        (key, json.dumps(value, ensure_ascii=False), now + ttl, now),
+                    )
+                    self._conn.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+                    # 超出容量时按最近访问时间淘汰 (LRU)
+                    self._conn.execute(
+                        "DELETE FROM cache WHERE key IN ("
+                        " SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                        (self.maxsize,),
+                    )
+                    self._size = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+                    self._conn.execute("COMMIT")
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.OperationalError as e:
+            logger.warning(f"SQLite 缓存写入失败，跳过本次写入: {e}")
+
+    def delete_prefix(self, prefix):
+        # 用范围查询代替 LIKE，避免前缀中的 % 和 _ 被当作通配符
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM cache WHERE key >= ? AND key < ?", (prefix, prefix + "\U0010ffff"))
+        self._size = self._count()
+        return cur.rowcount
+
+    def clear(self):
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM cache")
+        self._size = 0
+        return cur.rowcount
+
+    def __len__(self):
+        # 最近一次写入时统计的条目数，统计接口在事件循环里调用，不为此查询数据库
+        return self._size
+
+
+async def call_backend(backend, method, *args):
+    """调用缓存后端的方法；阻塞型后端 (SQLite) 放到线程池执行，避免卡住事件循环。"""
+    fn = getattr(backend, method)
+    if backend.blocking:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+def backend_from_env(prefix, default_size):
+    """按 `<PREFIX>_BACKEND` (memory/sqlite)、`_PATH`、`_SIZE`、`_BUSY_TIMEOUT` 环境变量创建缓存后端。"""
+    kind = os.getenv(f"{prefix}_BACKEND", "memory")
+    size = int(os.getenv(f"{prefix}_SIZE", default_size))
+    if kind == "sqlite":
+        return SQLiteBackend(os.getenv(f"{prefix}_PATH", f"{prefix.lower()}.sqlite3"), maxsize=size,
+                             busy_timeout=float(os.getenv(f"{prefix}_BUSY_TIMEOUT", 0.2)))
+    return MemoryBackend(maxsize=size)
+
+
+class SearchCache:
+    """Bocha 搜索结果缓存：归一化查询做键，TTL + LRU，并对并发的相同查询只发一次上游请求。"""
+
+    def __init__(self, backend, ttl=None):
+        self.backend = backend
+        self.ttl = ttl
+        self._inflight = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+    @classmethod
+    def from_env(cls):
+        ttl = os.getenv("SEARCH_CACHE_TTL")
+        return cls(backend_from_env("SEARCH_CACHE", 1024), ttl=float(ttl) if ttl else None)
+
+    def ttl_for(self, freshness):
+        if self.ttl is not None:
+            return self.ttl
+        return FRESHNESS_TTL.get(freshness, FRESHNESS_TTL["noLimit"])
+
+    async def get_or_fetch(self, query, freshness, fetch):
+        """命中直接返回；否则调用 fetch() 获取结果，返回 None 表示失败且不写入缓存。"""
+        key = f"{freshness}:{normalize_query(query)}"
+        value = await call_backend(self.backend, "get", key)
+        if value is not None:
+            self.stats["hits"] += 1
+            return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = asyncio.ensure_future(self._fetch(key, freshness, fetch))
+            self._inflight[key] = task
+        # shield：某个等待者被取消时，不影响其他等待同一请求的调用方
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key, freshness, fetch):
+        try:
+            value = await fetch()
+            if value is not None:
+                await call_backend(self.backend, "set", key, value, self.ttl_for(freshness))
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def snapshot(self):
+        return {**self.stats, "inflight": len(self._inflight), "size": len(self.backend)}
@@ -0,0 +1,354 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from contextlib import asynccontextmanager, nullcontext
+
+import httpx
+
+import metrics
+from admission import Gate, parse_retry_after, remaining
+
+logger = logging.getLogger("ECUST_Assistant")
+
+
+def _env_float(name, default):
+    return float(os.getenv(name, default))
+
+
+def _env_int(name, default):
+    return int(os.getenv(name, default))
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，直接跳过该上游。"""
+
+
+class CircuitBreaker:
+    """简单的三态熔断器：closed -> open -> half-open -> closed。"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._probing:
+            # 半开状态只放行一个探测请求
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+    def release_probe(self):
+        """探测请求没有得出结果 (被取消、被准入控制拒绝等) 时归还探测名额，让下一个请求继续探测。"""
+        self._probing = False
+
+
+class Upstream:
+    """单个上游 API 的长连接客户端，带连接池、分离超时、重试、熔断和准入控制。"""
+
+    # 这些状态码说明上游暂时不可用，可安全重试 (仅限幂等请求)
+    RETRY_STATUS = {502, 503, 504}
+
+    def __init__(self, name, base_url, api_key, *, max_connections=20, max_keepalive=10,
+                 keepalive_expiry=30.0, connect_timeout=5.0, read_timeout=60.0,
+                 retries=2, backoff_base=0.2, backoff_max=2.0, http2=False, breaker=None,
+                 first_byte_stage=None, gate=None, deadline_timeout=False):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive,
+                                   keepalive_expiry=keepalive_expiry)
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout, pool=connect_timeout)
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.http2 = http2
+        self.breaker = breaker
+        # 收到响应头时记录到该阶段的延迟直方图 (例如 llm_first_byte)
+        self.first_byte_stage = first_byte_stage
+        # 准入控制 (并发 + 排队 + 限速)，见 admission.py
+        self.gate = gate
+        # 为 True 时每次尝试的超时不超过当前请求剩余的时间 (用于可以放弃的上游，例如搜索)
+        self.deadline_timeout = deadline_timeout
+        self.client = None
+
+    @classmethod
+    def from_env(cls, name, base_url, api_key, first_byte_stage=None, **defaults):
+        """按 `<NAME>_*` 环境变量覆盖默认参数，例如 BOCHA_READ_TIMEOUT=8。"""
+        prefix = name.upper()
+        kwargs = {
+            "max_connections": _env_int(f"{prefix}_MAX_CONNECTIONS", defaults.get("max_connections", 20)),
+            "max_keepalive": _env_int(f"{prefix}_MAX_KEEPALIVE", defaults.get("max_keepalive", 10)),
+            "connect_timeout": _env_float(f"{prefix}_CONNECT_TIMEOUT", defaults.get("connect_timeout", 5.0)),
+            "read_timeout": _env_float(f"{prefix}_READ_TIMEOUT", defaults.get("read_timeout", 60.0)),
+            "retries": _env_int(f"{prefix}_RETRIES", defaults.get("retries", 2)),
+            "http2": os.getenv("UPSTREAM_HTTP2", "0") == "1",
+            "deadline_timeout": defaults.get("deadline_timeout", False),
+        }
+        threshold = _env_int(f"{prefix}_BREAKER_FAILURES", defaults.get("breaker_failures", 0))
+        if threshold > 0:
+            kwargs["breaker"] = CircuitBreaker(
+                failure_threshold=threshold,
+                reset_timeout=_env_float(f"{prefix}_BREAKER_RESET", defaults.get("breaker_reset", 30.0)),
+            )
+        kwargs["gate"] = Gate.from_env(
+            name,
+            concurrency=kwargs["max_connections"],
+            max_queue=defaults.get("queue", 100),
+            rate=defaults.get("rate", 0),
+            burst=defaults.get("burst", 1),
+            reserve=defaults.get("reserve", 0.0),
+        )
+        return cls(name, os.getenv(f"{prefix}_BASE_URL", base_url), api_key,
+                   first_byte_stage=first_byte_stage, **kwargs)
+
+    async def start(self):
+        http2 = self.http2
+        if http2:
+            try:
+                import h2  # noqa: F401  (httpx 的 HTTP/2 支持依赖 h2)
+            except ImportError:
+                logger.warning(f"{self.name}: 未安装 h2，回退到 HTTP/1.1")
+                http2 = False
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"Authorization": f"Bearer {self.api_key}"},
+            limits=self.limits,
+            timeout=self.timeout,
+            http2=http2,
+            event_hooks={"request": [self._on_request], "response": [self._on_response]},
+        )
+
+    async def _on_request(self, request):
+        request.extensions["ecust_start"] = time.perf_counter()
+
+    async def _on_response(self, response):
+        # 响应钩子在读取响应体之前触发，此时的耗时即首字节时间
+        metrics.UPSTREAM_RESPONSES.labels(self.name, response.status_code).inc()
+        start = response.request.extensions.get("ecust_start")
+        if self.first_byte_stage and start is not None:
+            metrics.observe_stage(self.first_byte_stage, time.perf_counter() - start)
+
+    def _count_error(self, error):
+        kind = "timeout" if isinstance(error, httpx.TimeoutException) else "transport"
+        metrics.UPSTREAM_ERRORS.labels(self.name, kind).inc()
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _backoff(self, attempt):
+        # full jitter：在 [0, min(上限, 基数 * 2^n)] 中随机等待，避免重试风暴
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _check_breaker(self):
+        """检查熔断器，返回本次调用是否占用了半开状态的探测名额。"""
+        if self.breaker is None:
+            return False
+        probe = self.breaker.state == "half-open"
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.name} 熔断中，跳过请求")
+        return probe
+
+    def _record(self, ok):
+        if self.breaker is not None:
+            if ok:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    def _attempt_timeout(self):
+        """本次尝试使用的超时：deadline_timeout 时按请求剩余时间收紧，否则为配置值。"""
+        left = remaining()
+        if not self.deadline_timeout or left is None:
+            return self.timeout
+        left = max(left, 0.001)
+        return httpx.Timeout(min(self.timeout.read, left), connect=min(self.timeout.connect, left),
+                             pool=min(self.timeout.pool, left), write=min(self.timeout.write, left))
+
+    def _fits(self, delay):
+        """等待 delay 秒后再发一次请求是否还赶得上截止时间。
+
+        deadline_timeout 的上游要留出完整的读超时，否则重试多半也会在截止时被截断；
+        其他上游至少要留出准入控制的 reserve。
+        """
+        left = remaining()
+        if left is None:
+            return True
+        if self.deadline_timeout:
+            needed = self.timeout.read
+        else:
+            needed = self.gate.reserve if self.gate is not None else 0.0
+        return delay + needed < left
+
+    def _slot(self):
+        return self.gate.slot() if self.gate is not None else nullcontext()
+
+    def _on_success(self):
+        if self.gate is not None:
+            self.gate.on_success()
+
+    def _throttled(self, response, attempt):
+        """处理 429：通知准入控制降速，返回重试前需要等待的秒数；不应再重试时返回 None。"""
+        retry_after = parse_retry_after(response.headers.get("retry-after"))
+        if self.gate is not None:
+            self.gate.on_throttled(retry_after)
+        if attempt >= self.retries:
+            return None
+        delay = retry_after if retry_after is not None else self._backoff(attempt)
+        if not self._fits(delay):
+            return None
+        # 有令牌桶时由桶负责暂停到 Retry-After 之后，这里不必重复等待
+        return 0.0 if self.gate is not None and self.gate.bucket is not None else delay
+
+    async def post(self, path, json, idempotent=False):
+        """发送 POST 请求。
+
+        连接阶段的失败 (请求尚未发出) 总会重试；读超时和 5xx 只在 idempotent=True 时重试；
+        429 在截止时间允许的情况下按 Retry-After 重试。
+        """
+        probe = self._check_breaker()
+        attempt = 0
+        try:
+            while True:
+                try:
+                    async with self._slot():
+                        response = await self.client.post(path, json=json, timeout=self._attempt_timeout())
+                except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                    self._count_error(e)
+                    reason, delay = e, self._backoff(attempt)
+                    if attempt >= self.retries or not self._fits(delay):
+                        self._record(False)
+                        raise
+                except httpx.TransportError as e:
+                    self._count_error(e)
+                    reason, delay = e, self._backoff(attempt)
+                    if not idempotent or attempt >= self.retries or not self._fits(delay):
+                        self._record(False)
+                        raise
+                else:
+                    if response.status_code == 429:
+                        reason, delay = "HTTP 429", self._throttled(response, attempt)
+                        if delay is None:
+                            # 重试用尽仍被限流，同样算作一次失败结果，半开探测据此重新打开熔断
+                            self._record(False)
+                            return response
+                    else:
+                        reason, delay = f"HTTP {response.status_code}", self._backoff(attempt)
+                        if (response.status_code not in self.RETRY_STATUS or not idempotent
+                                or attempt >= self.retries or not self._fits(delay)):
+                            self._record(response.status_code < 500)
+                            if response.is_success:
+                                self._on_success()
+                            return response
+
+                attempt += 1
+                logger.warning(f"{self.name} 请求失败 ({reason!r})，{delay:.2f}s 后第 {attempt} 次重试")
+                await asyncio.sleep(delay)
+        finally:
+            # 没有记录成功或失败就离开 (取消、被准入控制拒绝等) 时，不能一直占着探测名额；
+            # 已记录的路径在这里之前没有 await，归还不会影响其他请求
+            if probe:
+                self.breaker.release_probe()
+
+    @asynccontextmanager
+    async def stream(self, path, json):
+        """以流式方式发送 POST 请求，仅在连接阶段失败或 429 时重试。
+
+        整个流式读取期间都占用准入控制的并发名额。
+        """
+        probe = self._check_breaker()
+        attempt = 0
+        yielded = False
+        try:
+            while True:
+                try:
+                    async with self._slot():
+                        async with self.client.stream("POST", path, json=json,
+                                                      timeout=self._attempt_timeout()) as response:
+                            delay = self._throttled(response, attempt) if response.status_code == 429 else None
+                            if delay is None:
+                                self._record(response.status_code < 500 and response.status_code != 429)
+                                if response.is_success:
+                                    self._on_success()
+                                yielded = True
+                                yield response
+                                return
+                    reason = "HTTP 429"
+                except httpx.TransportError as e:
+                    self._count_error(e)
+                    # 已经把响应交给调用方后，或者不是连接阶段的错误，都不能重试
+                    retryable = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+                    delay = self._backoff(attempt)
+                    if yielded or not retryable or attempt >= self.retries or not self._fits(delay):
+                        self._record(False)
+                        raise
+                    reason = e
+                attempt += 1
+                logger.warning(f"{self.name} 请求失败 ({reason!r})，{delay:.2f}s 后第 {attempt} 次重试")
+                await asyncio.sleep(delay)
+        finally:
+            # 交出响应前已经记录过结果；在那之前离开的 (取消、被拒绝等) 要归还探测名额
+            if probe and not yielded:
+                self.breaker.release_probe()
+
+
+class UpstreamPool:
+    """应用生命周期内共享的上游客户端集合，由 FastAPI lifespan 负责启动和关闭。"""
+
+    def __init__(self, bocha, moonshot):
+        self.bocha = bocha
+        self.moonshot = moonshot
+
+    @classmethod
+    def from_env(cls, bocha_api_key, moonshot_api_key):
+        bocha = Upstream.from_env(
+            "bocha", "https://api.bochaai.com", bocha_api_key,
+            # 搜索是锦上添花：超时要短，失败时快速熔断，不拖慢整体回答
+            connect_timeout=3.0, read_timeout=10.0, retries=1,
+            breaker_failures=5, breaker_reset=30.0, deadline_timeout=True,
+            rate=20, burst=40, reserve=0.5,
+        )
+        moonshot = Upstream.from_env(
+            "moonshot", "https://api.moonshot.cn", moonshot_api_key, first_byte_stage="llm_first_byte",
+            connect_timeout=5.0, read_timeout=60.0, retries=2,
+            # reserve：至少要留出这么多秒给生成本身，否则不如直接返回繁忙
+            rate=10, burst=20, reserve=2.0,
+        )
+        return cls(bocha, moonshot)
+
+    async def start(self):
+        await self.bocha.start()
+        await self.moonshot.start()
+
+    async def aclose(self):
+        await self.bocha.aclose()
+        await self.moonshot.aclose()